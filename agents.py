@@ -1,125 +1,263 @@
 
-from typing import Any, Dict, List
+from typing import TYPE_CHECKING, Any, Callable, Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from langgraph.graph import StateGraph, END
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_community.document_loaders import PDFPlumberLoader, Docx2txtLoader
-from docx import Document
+from chunker_native import split_paragraphs
+from store import ResponseCache, Store
 from typing import List
+import asyncio
+import hashlib
+import logging
 import os
 
-os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
+if TYPE_CHECKING:
+    from docx.document import Document
 
-llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
 
-file_storage: Dict[str, Dict[str, Any]] = {}
+logger = logging.getLogger(__name__)
+
+# Caps in-flight LLM calls across all background tasks in this process
+LLM_CONCURRENCY = 16
+# Upper bound on a single streamed LLM call, once it holds a slot
+LLM_TIMEOUT_SECONDS = 120
+
+# One client per process, shared by every call. Async calls go over a
+# single gRPC channel that multiplexes concurrent requests as HTTP/2
+# streams, so there is no small connection pool to exhaust. Retries are
+# kept low so a failing call does not hold a semaphore slot for minutes.
+llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash",
+                             transport="grpc",
+                             max_retries=2)
+llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+# Target prompt size per chunk; fewer, larger chunks mean fewer LLM calls
+CHUNK_TOKENS = 6000
+# Rough ratio used to estimate tokens when tiktoken is unavailable
+CHARS_PER_TOKEN = 4
+
+# Dedicated threads for blocking document work, so parsing and writing
+# never compete with each other or with the default executor
+PARSER_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="parser")
+WRITER_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="writer")
+
+file_storage = Store()
+llm_cache = ResponseCache(file_storage.redis)
+
+# Prompt templates, built once; each prompt is PREFIX + chunk + SUFFIX
+V1_COMPLIANCE_PREFIX = (
+    "Check the following text for compliance with English grammar, style, clarity, "
+    "and professional writing rules. Return a structured JSON report:\n\n"
+)
+V1_COMPLIANCE_SUFFIX = ""
+
+V1_CORRECTION_PREFIX = (
+    "Correct the following text to fully comply with English grammar, style, clarity, "
+    "and professional writing rules.\n\n"
+    "INSTRUCTIONS:\n"
+    "1. Return ONLY the corrected text.\n"
+    "2. Do NOT add any explanations, summaries, or extra comments.\n"
+    "3. Keep the original paragraph structure.\n"
+    "4. Maintain the original meaning.\n\n"
+    "ORIGINAL TEXT:\n"
+)
+V1_CORRECTION_SUFFIX = "\n\nCORRECTED TEXT:"
+
+# Active prompt versions. Cache keys carry the version, so pointing these
+# at new V2_ constants invalidates previously cached responses.
+COMPLIANCE_PREFIX, COMPLIANCE_SUFFIX = V1_COMPLIANCE_PREFIX, V1_COMPLIANCE_SUFFIX
+CORRECTION_PREFIX, CORRECTION_SUFFIX = V1_CORRECTION_PREFIX, V1_CORRECTION_SUFFIX
+COMPLIANCE_CACHE_KEY = b"compliance-v1"
+CORRECTION_CACHE_KEY = b"correction-v1"
+
+
+# Default factories for every ComplianceState field
+_STATE_DEFAULTS: Dict[str, Callable[[], Any]] = {
+    "file_path": str,
+    "paragraphs": list,
+    "chunks": list,
+    "compliance_reports": list,
+    "corrected_chunks": list,
+    "corrected_paragraphs": list,
+    "output_path": str,
+}
 
 
 class ComplianceState(Dict[str, Any]):
     """
     Shared state for agent workflow.
-    Attributes:
+    A plain dict; the annotations below only describe its keys.
+    Keys:
         file_path (str): Path to the input document (PDF or DOCX).
-        original_text (str): Full text extracted from the document.
+        paragraphs (List[str]): Paragraphs extracted from the document.
         chunks (List[str]): Paragraph-based chunks of the text.
         compliance_reports (List[str]): Raw compliance reports for each chunk.
         corrected_chunks (List[str]): Corrected text chunks from Agent2.
-        final_corrected_doc (str): Full corrected document text.
+        corrected_paragraphs (List[str]): Paragraphs of the corrected document.
         output_path (str): Path where the corrected Word file is saved.
     """
     file_path: str
-    original_text: str
+    paragraphs: List[str]
     chunks: List[str]
     compliance_reports: List[str]
     corrected_chunks: List[str]
-    final_corrected_doc: str
+    corrected_paragraphs: List[str]
     output_path: str
 
     def __init__(self, **kwargs: Any):
-        super().__init__()
-        self.file_path = kwargs.get("file_path", "")
-        self.original_text = kwargs.get("original_text", "")
-        self.chunks = kwargs.get("chunks", [])
-        self.compliance_reports = kwargs.get("compliance_reports", [])
-        self.corrected_chunks = kwargs.get("corrected_chunks", [])
-        self.final_corrected_doc = kwargs.get("final_corrected_doc", "")
-        self.output_path = kwargs.get("output_path", "")
-        # Add all attributes to the underlying dict
-        self.update({
-            "file_path": self.file_path,
-            "original_text": self.original_text,
-            "chunks": self.chunks,
-            "compliance_reports": self.compliance_reports,
-            "corrected_chunks": self.corrected_chunks,
-            "final_corrected_doc": self.final_corrected_doc,
-            "output_path": self.output_path
+        super().__init__({
+            key: kwargs[key] if key in kwargs else default()
+            for key, default in _STATE_DEFAULTS.items()
         })
 
 
 async def load_document_node(state: ComplianceState) -> ComplianceState:
-    """Load PDF/DOCX and extract text"""
+    """Load PDF/DOCX and extract its paragraphs (parsing runs on PARSER_POOL)"""
     file_path = state["file_path"]
+    loop = asyncio.get_running_loop()
 
+    # Loaders are imported lazily so each workload only pulls in its parser
     if file_path.endswith(".pdf"):
+        from langchain_community.document_loaders import PDFPlumberLoader
         loader = PDFPlumberLoader(file_path)
-        docs = loader.load()
-        text = "\n\n".join([doc.page_content for doc in docs])
+        docs = await loop.run_in_executor(PARSER_POOL, loader.load)
     elif file_path.endswith(".docx"):
+        from langchain_community.document_loaders import Docx2txtLoader
         loader = Docx2txtLoader(file_path)
-        docs = loader.load()
-        text = "\n\n".join([doc.page_content for doc in docs])
+        docs = await loop.run_in_executor(PARSER_POOL, loader.load)
     else:
         raise ValueError("Only PDF and DOCX supported.")
 
-    state["original_text"] = text
+    # Pages are split individually; a page break is also a paragraph break
+    state["paragraphs"] = [
+        para for doc in docs for para in split_paragraphs(doc.page_content)
+    ]
     return state
 
 
-async def chunk_text_node(state: ComplianceState) -> ComplianceState:
-    """Split text into paragraph-based chunks of max 2000 chars"""
-    text = state["original_text"]
-    chunks = await paragraph_chunk_split(text, chunk_size=2000)
+def chunk_text_node(state: ComplianceState) -> ComplianceState:
+    """Pack paragraphs into chunks of about CHUNK_TOKENS tokens"""
+    chunks = paragraph_chunk_split(state["paragraphs"])
     state["chunks"] = chunks
     return state
 
 
+async def _invoke_llm(prompt: str) -> str:
+    """Stream an LLM response under the shared concurrency limit"""
+    pieces = []
+    async with llm_semaphore:
+        # Debug logs show whether concurrent calls actually overlap
+        logger.debug("LLM call started (%d prompt chars)", len(prompt))
+        async with asyncio.timeout(LLM_TIMEOUT_SECONDS):
+            async for piece in llm.astream(prompt):
+                pieces.append(piece.content)
+        logger.debug("LLM call finished")
+    return "".join(pieces)
+
+
+def _chunk_digest(cache_key: bytes, chunk: str) -> str:
+    """Content hash of a chunk, keyed by prompt kind and version"""
+    return hashlib.blake2b(chunk.encode(), digest_size=16, key=cache_key).hexdigest()
+
+
+async def _cached_llm_calls(chunks: List[str],
+                            prompt_fn: Callable[[str], str],
+                            cache_key: bytes) -> List[str]:
+    """
+    Return the LLM response for each chunk, in order.
+    Responses are looked up in the cache first; only distinct missing
+    chunks are sent to the LLM, concurrently, and then cached.
+    """
+    digests = [_chunk_digest(cache_key, chunk) for chunk in chunks]
+    results = await llm_cache.get_many(digests)
+
+    misses: Dict[str, str] = {}
+    for digest, chunk, cached in zip(digests, chunks, results):
+        if cached is None:
+            misses.setdefault(digest, chunk)
+
+    # A failing chunk cancels the other in-flight streams
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tasks = {digest: tg.create_task(_invoke_llm(prompt_fn(chunk)))
+                     for digest, chunk in misses.items()}
+    except ExceptionGroup as eg:
+        # Surface the underlying error so it is what gets stored on the file
+        raise eg.exceptions[0]
+    fresh = {digest: task.result() for digest, task in tasks.items()}
+    await llm_cache.set_many(fresh)
+
+    return [cached if cached is not None else fresh[digest]
+            for digest, cached in zip(digests, results)]
+
+
+def _compliance_prompt(chunk: str) -> str:
+    """Build the compliance check prompt for one chunk"""
+    return "".join((COMPLIANCE_PREFIX, chunk, COMPLIANCE_SUFFIX))
+
+
+def _correction_prompt(chunk: str) -> str:
+    """Build the correction prompt for one chunk"""
+    return "".join((CORRECTION_PREFIX, chunk, CORRECTION_SUFFIX))
+
+
 async def compliance_check_node(state: ComplianceState) -> ComplianceState:
-    """Check compliance for each chunk"""
-    reports = []
-    for chunk in state["chunks"]:
-        response = await llm.ainvoke(
-            f"Check the following text for compliance with English grammar, style, clarity, "
-            f"and professional writing rules. Return a structured JSON report:\n\n{chunk}"
-        )
-        reports.append(response.content)
+    """Check compliance for each chunk concurrently"""
+    reports = await _cached_llm_calls(
+        state["chunks"], _compliance_prompt, COMPLIANCE_CACHE_KEY)
 
     state["compliance_reports"] = reports
     return state
 
 
 async def correct_document_node(state: ComplianceState) -> ComplianceState:
-    """Correct each chunk and assemble corrected text strictly"""
-    corrected_chunks = []
-
-    for chunk in state["chunks"]:
-        response = await llm.ainvoke(
-            f"Correct the following text to fully comply with English grammar, style, clarity, "
-            f"and professional writing rules.\n\n"
-            f"INSTRUCTIONS:\n"
-            f"1. Return ONLY the corrected text.\n"
-            f"2. Do NOT add any explanations, summaries, or extra comments.\n"
-            f"3. Keep the original paragraph structure.\n"
-            f"4. Maintain the original meaning.\n\n"
-            f"ORIGINAL TEXT:\n{chunk}\n\n"
-            f"CORRECTED TEXT:"
-        )
-        # Ensure we strip any accidental leading/trailing whitespace
-        corrected_chunks.append(response.content.strip())
+    """Correct each chunk concurrently and assemble corrected text strictly"""
+    responses = await _cached_llm_calls(
+        state["chunks"], _correction_prompt, CORRECTION_CACHE_KEY)
+    # Ensure we strip any accidental leading/trailing whitespace
+    corrected_chunks = [content.strip() for content in responses]
 
     state["corrected_chunks"] = corrected_chunks
-    state["final_corrected_doc"] = "\n\n".join(corrected_chunks)
+    state["corrected_paragraphs"] = [
+        para for chunk in corrected_chunks for para in split_paragraphs(chunk)
+    ]
     return state
 
 
+def _append_paragraphs(doc: "Document", paragraphs: List[str]) -> None:
+    """
+    Append plain-text paragraphs to the document body as raw w:p elements.
+    Equivalent to doc.add_paragraph(text) per paragraph (line breaks become
+    w:br), without building a Paragraph proxy for each one.
+    """
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+
+    body = doc.element.body
+    # Paragraphs must come before the trailing section properties
+    sect_pr = body.sectPr
+
+    for text in paragraphs:
+        p = OxmlElement("w:p")
+        r = OxmlElement("w:r")
+        for i, line in enumerate(text.split("\n")):
+            if i:
+                r.append(OxmlElement("w:br"))
+            t = OxmlElement("w:t")
+            if line != line.strip():
+                t.set(qn("xml:space"), "preserve")
+            t.text = line
+            r.append(t)
+        p.append(r)
+
+        if sect_pr is not None:
+            sect_pr.addprevious(p)
+        else:
+            body.append(p)
+
+
 async def save_corrected_doc_node(state: ComplianceState) -> ComplianceState:
     """Save corrected text as Word file"""
     output_dir = "output"
@@ -129,17 +267,20 @@ async def save_corrected_doc_node(state: ComplianceState) -> ComplianceState:
     file_id = os.path.basename(state["file_path"]).split('.')[0]
     output_path = os.path.join(output_dir, f"corrected_{file_id}.docx")
 
+    # python-docx pulls in lxml, so only import it when a file is written
+    from docx import Document
+
     doc = Document()
-    for para in state["final_corrected_doc"].split("\n\n"):
-        if para.strip():
-            doc.add_paragraph(para.strip())
+    _append_paragraphs(doc, state["corrected_paragraphs"])
 
-    doc.save(output_path)
+    # Serializing the docx is blocking I/O, keep it off the event loop
+    await asyncio.get_running_loop().run_in_executor(
+        WRITER_POOL, doc.save, output_path)
     state["output_path"] = output_path
     return state
 
 
-async def build_compliance_workflow():
+def build_compliance_workflow():
     """Build compliance checking workflow"""
     graph = StateGraph(ComplianceState)
     graph.add_node("load", load_document_node)
@@ -154,7 +295,7 @@ async def build_compliance_workflow():
     return graph.compile()
 
 
-async def build_correction_workflow():
+def build_correction_workflow():
     """Build correction workflow"""
     graph = StateGraph(ComplianceState)
     graph.add_node("correct", correct_document_node)
@@ -167,28 +308,54 @@ async def build_correction_workflow():
     return graph.compile()
 
 
-async def paragraph_chunk_split(text: str,
-                                chunk_size: int = 2000) -> List[str]:
+# Compiled graphs hold no per-run state, so they are built once and reused
+COMPLIANCE_WORKFLOW = build_compliance_workflow()
+CORRECTION_WORKFLOW = build_correction_workflow()
+
+
+@lru_cache(maxsize=1)
+def _token_encoder():
+    """Return a tiktoken encoder, or None when tiktoken is unavailable"""
+    try:
+        import tiktoken
+        # cl100k_base is a close-enough proxy for Gemini's tokenizer
+        return tiktoken.get_encoding("cl100k_base")
+    except (ImportError, OSError):
+        return None
+
+
+def _count_tokens(text: str) -> int:
+    """Count tokens with tiktoken, or estimate from length as a fallback"""
+    encoder = _token_encoder()
+    if encoder is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def paragraph_chunk_split(paragraphs: List[str],
+                          max_tokens: int = CHUNK_TOKENS) -> List[str]:
     """
-    Split text into chunks of max `chunk_size` characters,
+    Pack paragraphs into chunks of about `max_tokens` tokens,
     but always keep paragraphs intact.
-    Paragraphs are separated by double newlines (\n\n).
+    Paragraphs within a chunk are joined by double newlines (\n\n).
     """
-    paragraphs = text.split("\n\n")
     chunks = []
-    current_chunk = ""
+    buf: List[str] = []
+    cur_tokens = 0
 
     for para in paragraphs:
-        para_with_newline = para.strip() + "\n\n"
-        if len(current_chunk) + len(para_with_newline) > chunk_size:
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            current_chunk = para_with_newline
+        # Account for the "\n\n" separator that joins paragraphs
+        para_tokens = _count_tokens(para) + 1
+        if cur_tokens + para_tokens > max_tokens and buf:
+            chunks.append("\n\n".join(buf))
+            buf = [para]
+            cur_tokens = para_tokens
         else:
-            current_chunk += para_with_newline
+            buf.append(para)
+            cur_tokens += para_tokens
 
-    if current_chunk:
-        chunks.append(current_chunk.strip())
+    if buf:
+        chunks.append("\n\n".join(buf))
 
     return chunks
 
@@ -196,43 +363,53 @@ async def paragraph_chunk_split(text: str,
 async def process_compliance_check(file_id: str, file_path: str):
     """Background task for compliance checking"""
     try:
-        file_storage[file_id]["status"] = "processing_compliance"
+        await file_storage.set(file_id, "status", "processing_compliance")
         state = ComplianceState(file_path=file_path)
-        agent1 = await build_compliance_workflow()
-        state = await agent1.ainvoke(state)
+        state = await COMPLIANCE_WORKFLOW.ainvoke(state)
 
         # Store results
-        file_storage[file_id]["compliance_reports"] = state["compliance_reports"]
-        file_storage[file_id]["chunks"] = state["chunks"]
-        file_storage[file_id]["original_text"] = state["original_text"]
-        file_storage[file_id]["state"] = state
-        file_storage[file_id]["status"] = "compliance_complete"
+        await file_storage.setmany(file_id, {
+            "compliance_reports": state["compliance_reports"],
+            "chunks": state["chunks"],
+            "paragraphs": state["paragraphs"],
+            "status": "compliance_complete"
+        })
 
     except Exception as e:
-        file_storage[file_id]["status"] = "error"
-        file_storage[file_id]["error"] = str(e)
+        await file_storage.setmany(file_id, {"status": "error", "error": str(e)})
 
 
 async def process_document_correction(file_id: str):
     """Background task for document correction"""
     try:
         # Update status
-        file_storage[file_id]["status"] = "processing_correction"
-
-        # Get existing state
-        state = file_storage[file_id]["state"]
+        await file_storage.set(file_id, "status", "processing_correction")
+
+        # Rehydrate state from the stored compliance results
+        file_info = await file_storage.get(file_id)
+        state = ComplianceState(
+            file_path=file_info["file_path"],
+            paragraphs=file_info["paragraphs"],
+            chunks=file_info["chunks"],
+            compliance_reports=file_info["compliance_reports"]
+        )
 
         # Run Agent2
-        agent2 = await build_correction_workflow()
-        state = await agent2.ainvoke(state)
+        state = await CORRECTION_WORKFLOW.ainvoke(state)
 
         # Store results
-        file_storage[file_id]["corrected_chunks"] = state["corrected_chunks"]
-        file_storage[file_id]["final_corrected_doc"] = state["final_corrected_doc"]
-        file_storage[file_id]["output_path"] = state["output_path"]
-        file_storage[file_id]["state"] = state
-        file_storage[file_id]["status"] = "correction_complete"
+        await file_storage.setmany(file_id, {
+            "corrected_chunks": state["corrected_chunks"],
+            "corrected_paragraphs": state["corrected_paragraphs"],
+            "output_path": state["output_path"],
+            "status": "correction_complete"
+        })
 
     except Exception as e:
-        file_storage[file_id]["status"] = "error"
-        file_storage[file_id]["error"] = str(e)
+        await file_storage.setmany(file_id, {"status": "error", "error": str(e)})
+
+
+def shutdown_pools():
+    """Wait for in-flight document work and stop the dedicated thread pools"""
+    PARSER_POOL.shutdown(wait=True)
+    WRITER_POOL.shutdown(wait=True)
@@ -0,0 +1,71 @@
+
+from typing import List
+
+# numba is optional; without it paragraphs are split with str.split
+try:
+    import numba
+    import numpy as np
+except ImportError:
+    numba = None
+
+# Below this size str.split beats encoding the text for the native scan
+NATIVE_MIN_CHARS = 1 << 20
+
+_NEWLINE = 10
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _scan(buf):
+        """
+        Return (starts, ends) byte offsets of the spans between runs of
+        two or more newlines in a UTF-8 buffer.
+        """
+        n = buf.shape[0]
+        starts = np.empty(n // 2 + 1, dtype=np.int64)
+        ends = np.empty(n // 2 + 1, dtype=np.int64)
+        count = 0
+        start = 0
+        i = 0
+
+        while i < n:
+            if buf[i] != _NEWLINE:
+                i += 1
+                continue
+            j = i
+            while j < n and buf[j] == _NEWLINE:
+                j += 1
+            if j - i >= 2:
+                if i > start:
+                    starts[count] = start
+                    ends[count] = i
+                    count += 1
+                start = j
+            i = j
+
+        if n > start:
+            starts[count] = start
+            ends[count] = n
+            count += 1
+
+        return starts[:count], ends[:count]
+
+
+def split_paragraphs(text: str) -> List[str]:
+    """
+    Split text on blank lines (\n\n) into stripped, non-empty paragraphs.
+    Large texts are scanned with a Numba-compiled kernel when available.
+    """
+    if numba is None or len(text) < NATIVE_MIN_CHARS:
+        return [para.strip() for para in text.split("\n\n") if para.strip()]
+
+    data = text.encode()
+    starts, ends = _scan(np.frombuffer(data, dtype=np.uint8))
+    paragraphs = []
+    # Newline bytes never occur inside a multi-byte UTF-8 sequence,
+    # so every span decodes cleanly
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        para = data[start:end].decode().strip()
+        if para:
+            paragraphs.append(para)
+    return paragraphs
@@ -1,17 +1,34 @@
+import json
 import os
 import uuid
 from typing import List, Optional
-from fastapi import FastAPI, UploadFile, File, BackgroundTasks, HTTPException
-from agents import process_compliance_check, process_document_correction
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
+from arq import create_pool
+from arq.connections import RedisSettings
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from agents import file_storage
-import shutil
+from store import REDIS_URL
+import aiofiles
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI(title="Document Compliance Service")
+app = FastAPI(title="Document Compliance Service",
+              default_response_class=ORJSONResponse)
+
+# Uploads are streamed to disk in 1 MiB reads
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 50 * 1024 * 1024))
+
+# Leading bytes expected for each supported extension (DOCX is a zip)
+FILE_SIGNATURES = {
+    ".pdf": b"%PDF",
+    ".docx": b"PK\x03\x04",
+}
+
+# Statuses after which no further events are expected
+FINAL_STATUSES = {"correction_complete", "error"}
 
 
 class FileUploadResponse(BaseModel):
@@ -38,14 +55,31 @@ class CorrectionResponse(BaseModel):
 
 
 @app.post("/upload", response_model=FileUploadResponse)
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(request: Request, file: UploadFile = File(...)):
     """Upload a PDF or DOCX file for processing"""
 
+    # Reject oversized uploads before anything touches disk
+    content_length = request.headers.get("content-length")
+    if (content_length and content_length.isdigit()
+            and int(content_length) > MAX_UPLOAD_BYTES) or \
+            (file.size is not None and file.size > MAX_UPLOAD_BYTES):
+        raise HTTPException(
+            status_code=413,
+            detail=f"File exceeds the {MAX_UPLOAD_BYTES} byte upload limit")
+
     # Validate file type
-    if not file.filename.endswith(('.pdf', '.docx')):
+    extension = os.path.splitext(file.filename)[1]
+    if extension not in FILE_SIGNATURES:
         raise HTTPException(status_code=400,
                             detail="Only PDF and DOCX files are supported")
 
+    # Check the content matches the extension
+    head = await file.read(8)
+    if not head.startswith(FILE_SIGNATURES[extension]):
+        raise HTTPException(
+            status_code=400,
+            detail=f"File content is not a valid {extension[1:].upper()} file")
+
     # Generate unique file ID
     file_id = str(uuid.uuid4())
 
@@ -56,23 +90,24 @@ async def upload_file(file: UploadFile = File(...)):
     file_path = os.path.join(temp_dir, f"{file_id}_{file.filename}")
 
     # Save uploaded file
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    async with aiofiles.open(file_path, "wb") as out:
+        await out.write(head)
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            await out.write(chunk)
 
     # Initialize file storage
-    file_storage[file_id] = {
+    await file_storage.setmany(file_id, {
         "file_path": file_path,
         "original_filename": file.filename,
         "status": "uploaded",
         "compliance_reports": [],
         "chunks": [],
-        "original_text": "",
+        "paragraphs": [],
         "corrected_chunks": [],
-        "final_corrected_doc": "",
+        "corrected_paragraphs": [],
         "output_path": "",
-        "state": None,
         "error": None
-    }
+    })
 
     return FileUploadResponse(
         file_id=file_id,
@@ -81,22 +116,21 @@ async def upload_file(file: UploadFile = File(...)):
 
 
 @app.post("/check_compliance/{file_id}", response_model=ComplianceResponse)
-async def check_compliance(file_id: str, background_tasks: BackgroundTasks):
+async def check_compliance(file_id: str, request: Request):
     """Start compliance checking for uploaded file"""
 
-    if file_id not in file_storage:
+    file_info = await file_storage.get(file_id)
+    if file_info is None:
         raise HTTPException(status_code=404, detail="File not found")
 
-    file_info = file_storage[file_id]
-
     if file_info["status"] not in ["uploaded", "compliance_complete"]:
         raise HTTPException(
             status_code=400,
             detail=f"File is currently {
                 file_info['status']}")
 
-    background_tasks.add_task(
-        process_compliance_check,
+    await request.app.state.arq_pool.enqueue_job(
+        "compliance_task",
         file_id,
         file_info["file_path"])
 
@@ -108,22 +142,21 @@ async def check_compliance(file_id: str, background_tasks: BackgroundTasks):
 
 
 @app.post("/correct_document/{file_id}", response_model=CorrectionResponse)
-async def correct_document(file_id: str, background_tasks: BackgroundTasks):
+async def correct_document(file_id: str, request: Request):
     """Start document correction for a file that has been compliance checked"""
 
-    if file_id not in file_storage:
+    file_info = await file_storage.get(file_id)
+    if file_info is None:
         raise HTTPException(status_code=404, detail="File not found")
 
-    file_info = file_storage[file_id]
-
     if file_info["status"] != "compliance_complete":
         raise HTTPException(
             status_code=400,
             detail=f"File must be compliance checked first. Current status: {
                 file_info['status']}")
 
-    # Add background task
-    background_tasks.add_task(process_document_correction, file_id)
+    # Queue the job for the worker pool
+    await request.app.state.arq_pool.enqueue_job("correction_task", file_id)
 
     return CorrectionResponse(
         file_id=file_id,
@@ -135,11 +168,10 @@ async def correct_document(file_id: str, background_tasks: BackgroundTasks):
 async def get_status(file_id: str):
     """Get the current processing status of a file"""
 
-    if file_id not in file_storage:
+    file_info = await file_storage.get(file_id)
+    if file_info is None:
         raise HTTPException(status_code=404, detail="File not found")
 
-    file_info = file_storage[file_id]
-
     response = StatusResponse(
         file_id=file_id,
         status=file_info["status"],
@@ -162,15 +194,41 @@ async def get_status(file_id: str):
     return response
 
 
+@app.get("/events/{file_id}")
+async def stream_events(file_id: str):
+    """Push status changes for a file as Server-Sent Events"""
+
+    if await file_storage.get(file_id) is None:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    async def event_gen():
+        async with file_storage.events(file_id) as events:
+            # Read the current status only after subscribing, so a change
+            # made in between is still delivered
+            file_info = await file_storage.get(file_id)
+            if file_info is None:
+                return
+            event = {"status": file_info["status"], "error": file_info["error"]}
+
+            while True:
+                yield f"data: {json.dumps({'file_id': file_id, **event})}\n\n"
+                if event["status"] in FINAL_STATUSES:
+                    return
+                event = await anext(events)
+
+    return StreamingResponse(event_gen(),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
 @app.get("/download/{file_id}")
 async def download_file(file_id: str):
     """Download the corrected document"""
 
-    if file_id not in file_storage:
+    file_info = await file_storage.get(file_id)
+    if file_info is None:
         raise HTTPException(status_code=404, detail="File not found")
 
-    file_info = file_storage[file_id]
-
     if file_info["status"] != "correction_complete":
         raise HTTPException(
             status_code=400,
@@ -187,37 +245,18 @@ async def download_file(file_id: str):
     )
 
 
-async def paragraph_chunk_split_async(
-        text: str, chunk_size: int = 2000) -> List[str]:
-    """
-    Split text into chunks of max `chunk_size` characters,
-    but always keep paragraphs intact.
-    Paragraphs are separated by double newlines (\n\n).
-    """
-    paragraphs = text.split("\n\n")
-    chunks = []
-    current_chunk = ""
-
-    for para in paragraphs:
-        para_with_newline = para.strip() + "\n\n"
-        if len(current_chunk) + len(para_with_newline) > chunk_size:
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            current_chunk = para_with_newline
-        else:
-            current_chunk += para_with_newline
-
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-
-    return chunks
-
-
 @app.on_event("startup")
 async def startup_event():
-    """Create necessary directories on startup"""
+    """Create necessary directories and the job queue pool on startup"""
     os.makedirs("temp_uploads", exist_ok=True)
     os.makedirs("output", exist_ok=True)
+    app.state.arq_pool = await create_pool(RedisSettings.from_dsn(REDIS_URL))
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close the job queue pool"""
+    await app.state.arq_pool.aclose()
 
 
 @app.get("/")
@@ -227,5 +266,9 @@ async def root():
 
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop is not available on Windows
+    uvicorn.run(app, host="0.0.0.0", port=8000,
+                loop="asyncio" if sys.platform == "win32" else "uvloop",
+                http="httptools")
@@ -0,0 +1,114 @@
+
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Mapping, Optional
+import json
+import os
+
+import redis.asyncio as redis
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Files not touched for a day are evicted
+FILE_TTL_SECONDS = 24 * 60 * 60
+
+
+class Store:
+    """
+    Per-file processing state kept in Redis.
+    Each file is a hash at `file:{file_id}`; field values are JSON encoded
+    so lists and None round-trip. Every write refreshes the hash TTL.
+    Status changes are also published on `file:{file_id}:events`.
+    """
+
+    def __init__(self, url: str = REDIS_URL, ttl: int = FILE_TTL_SECONDS):
+        self.redis = redis.from_url(url, decode_responses=True)
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(file_id: str) -> str:
+        return f"file:{file_id}"
+
+    @staticmethod
+    def _channel(file_id: str) -> str:
+        return f"file:{file_id}:events"
+
+    async def get(self, file_id: str) -> Optional[Dict[str, Any]]:
+        """Return all fields for a file, or None if it is unknown/expired"""
+        raw = await self.redis.hgetall(self._key(file_id))
+        if not raw:
+            return None
+        return {field: json.loads(value) for field, value in raw.items()}
+
+    async def set(self, file_id: str, field: str, value: Any) -> None:
+        """Set a single field for a file"""
+        await self.setmany(file_id, {field: value})
+
+    async def setmany(self, file_id: str, mapping: Mapping[str, Any]) -> None:
+        """Set several fields for a file in one round trip"""
+        key = self._key(file_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={
+                field: json.dumps(value) for field, value in mapping.items()
+            })
+            pipe.expire(key, self.ttl)
+            if "status" in mapping:
+                pipe.publish(self._channel(file_id), json.dumps({
+                    "status": mapping["status"],
+                    "error": mapping.get("error")
+                }))
+            await pipe.execute()
+
+    @asynccontextmanager
+    async def events(self, file_id: str) -> AsyncIterator[AsyncIterator[Dict[str, Any]]]:
+        """
+        Subscribe to status changes for a file.
+        Yields an async iterator of `{"status", "error"}` events; the
+        subscription is active as soon as the context is entered.
+        """
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(self._channel(file_id))
+
+        async def messages() -> AsyncIterator[Dict[str, Any]]:
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    yield json.loads(message["data"])
+
+        try:
+            yield messages()
+        finally:
+            await pubsub.aclose()
+
+
+# Cached LLM responses are kept for a week
+RESPONSE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+
+class ResponseCache:
+    """
+    Content-addressed cache of LLM responses kept in Redis.
+    Keys are digests of the chunk text and prompt version, stored
+    under `llm:{digest}` as plain strings.
+    """
+
+    def __init__(self, client: redis.Redis, ttl: int = RESPONSE_TTL_SECONDS):
+        self.redis = client
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(digest: str) -> str:
+        return f"llm:{digest}"
+
+    async def get_many(self, digests: List[str]) -> List[Optional[str]]:
+        """Return cached responses in order, None for misses"""
+        if not digests:
+            return []
+        return await self.redis.mget([self._key(d) for d in digests])
+
+    async def set_many(self, responses: Mapping[str, str]) -> None:
+        """Cache several responses in one round trip"""
+        if not responses:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for digest, response in responses.items():
+                pipe.set(self._key(digest), response, ex=self.ttl)
+            await pipe.execute()
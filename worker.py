@@ -0,0 +1,38 @@
+
+from typing import Any, Dict
+from arq.connections import RedisSettings
+from agents import process_compliance_check, process_document_correction, shutdown_pools
+from store import REDIS_URL
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+async def compliance_task(ctx: Dict[str, Any], file_id: str, file_path: str):
+    """Queued job for compliance checking"""
+    await process_compliance_check(file_id, file_path)
+
+
+async def correction_task(ctx: Dict[str, Any], file_id: str):
+    """Queued job for document correction"""
+    await process_document_correction(file_id)
+
+
+async def shutdown(ctx: Dict[str, Any]):
+    """Stop the document thread pools when the worker exits"""
+    shutdown_pools()
+
+
+class WorkerSettings:
+    """
+    ARQ worker configuration.
+    Run with: arq worker.WorkerSettings
+    """
+    functions = [compliance_task, correction_task]
+    on_shutdown = shutdown
+    redis_settings = RedisSettings.from_dsn(REDIS_URL)
+    # Upper bound on documents processed at once by one worker
+    max_jobs = 32
+    job_timeout = 30 * 60
+    # Jobs interrupted by a worker crash or restart are retried
+    max_tries = 3